@@ -0,0 +1,350 @@
+"""
+Load generator for the web-app -> ml-client -> mongodb chain.
+
+Replays a weighted mix of audio clips against the web app's ``/upload`` route,
+either open-loop at a target request rate (``--rps``) or closed-loop with a
+fixed number of concurrent clients (``--concurrency``), and writes a JSON
+report with latency distributions, error rates and timeouts. Reports from
+several runs can be compared side by side.
+
+Example:
+    python loadtest.py run --clip ../audio.wav@3 --clip synth:webm:8 \\
+        --rps 20 --duration 60 --output baseline.json
+    python loadtest.py compare baseline.json tuned.json
+"""
+
+import argparse
+import array
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+SAMPLE_RATE = 16000
+CONTENT_TYPES = {
+    "wav": "audio/wav",
+    "webm": "audio/webm",
+    "ogg": "audio/ogg",
+}
+PERCENTILES = (50, 90, 95, 99)
+# Open-loop runs give up on keeping the target rate beyond this many in flight.
+MAX_IN_FLIGHT = 256
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open.
+HISTOGRAM_BOUNDS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+COMPARE_METRICS = (
+    "throughput_rps",
+    "error_rate",
+    "timeouts",
+    "latency_ms.p50",
+    "latency_ms.p95",
+    "latency_ms.p99",
+    "latency_ms.max",
+)
+
+
+def synthesize_wav(seconds, sample_rate=SAMPLE_RATE):
+    """Return the bytes of a mono 16-bit WAV file holding a gliding tone."""
+    samples = array.array("h")
+    for index in range(int(seconds * sample_rate)):
+        phase = 2 * math.pi * (220 + 20 * index / sample_rate) * index / sample_rate
+        samples.append(int(8000 * math.sin(phase)))
+    buffer = io.BytesIO()
+    with wave.Wave_write(buffer) as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(sample_rate)
+        writer.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def transcode(wav_bytes, fmt):
+    """Encode WAV bytes as ``fmt`` (webm/ogg) with a local ffmpeg."""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError(f"ffmpeg is required to synthesize {fmt} clips")
+    codec = "libopus" if fmt == "webm" else "libvorbis"
+    result = subprocess.run(
+        [ffmpeg, "-loglevel", "error", "-f", "wav", "-i", "pipe:0"]
+        + ["-c:a", codec, "-f", fmt, "pipe:1"],
+        input=wav_bytes,
+        capture_output=True,
+        check=True,
+    )
+    return result.stdout
+
+
+def load_clip(spec):
+    """Parse a ``--clip`` spec into a clip dict.
+
+    A spec is either a file path or ``synth:<format>:<seconds>``, optionally
+    followed by ``@<weight>`` (default 1).
+    """
+    source, _, weight = spec.partition("@")
+    clip = {"weight": float(weight or 1)}
+    if source.startswith("synth:"):
+        _, fmt, seconds = source.split(":")
+        if fmt not in CONTENT_TYPES:
+            raise ValueError(f"unsupported synthetic format: {fmt}")
+        data = synthesize_wav(float(seconds))
+        if fmt != "wav":
+            data = transcode(data, fmt)
+        clip.update(name=source, filename=f"synthetic.{fmt}", data=data)
+    else:
+        with open(source, "rb") as audio_file:
+            data = audio_file.read()
+        clip.update(name=source, filename=os.path.basename(source), data=data)
+    extension = clip["filename"].rsplit(".", 1)[-1].lower()
+    clip["content_type"] = CONTENT_TYPES.get(extension, "application/octet-stream")
+    return clip
+
+
+def send(url, clip, timeout, scheduled=None):
+    """Upload one clip and return a sample dict describing the outcome.
+
+    For open-loop runs latency is measured from ``scheduled`` rather than from
+    the moment the request was sent, so queueing in the generator counts.
+    """
+    start = scheduled if scheduled is not None else time.monotonic()
+    sample = {"clip": clip["name"], "status": None, "error": None}
+    try:
+        response = requests.post(
+            url,
+            files={"audio": (clip["filename"], clip["data"], clip["content_type"])},
+            timeout=timeout,
+        )
+        sample["status"] = response.status_code
+        if response.status_code >= 400:
+            sample["error"] = f"http_{response.status_code}"
+    except requests.Timeout:
+        sample["error"] = "timeout"
+    except requests.RequestException:
+        sample["error"] = "connection"
+    sample["latency_ms"] = (time.monotonic() - start) * 1000
+    return sample
+
+
+def run_open_loop(url, clips, rps, duration, timeout):
+    """Fire requests at a fixed rate regardless of how fast responses come back."""
+    rng = random.Random(0)
+    weights = [clip["weight"] for clip in clips]
+    futures = []
+    interval = 1.0 / rps
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as executor:
+        begin = time.monotonic()
+        for index in range(int(rps * duration)):
+            scheduled = begin + index * interval
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            clip = rng.choices(clips, weights)[0]
+            futures.append(executor.submit(send, url, clip, timeout, scheduled))
+    return [future.result() for future in futures]
+
+
+def run_closed_loop(url, clips, concurrency, duration, timeout):
+    """Keep ``concurrency`` clients busy, each sending back-to-back requests."""
+    weights = [clip["weight"] for clip in clips]
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            sample = send(url, rng.choices(clips, weights)[0], timeout)
+            with lock:
+                samples.append(sample)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty sorted list."""
+    rank = max(math.ceil(pct / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+
+def latency_stats(samples):
+    """Percentiles, mean, max and histogram of the successful latencies."""
+    latencies = sorted(s["latency_ms"] for s in samples if s["error"] is None)
+    if not latencies:
+        return {}
+    stats = {f"p{pct}": percentile(latencies, pct) for pct in PERCENTILES}
+    stats["mean"] = sum(latencies) / len(latencies)
+    stats["max"] = latencies[-1]
+    histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    for latency in latencies:
+        bucket = sum(latency > bound for bound in HISTOGRAM_BOUNDS_MS)
+        histogram[bucket] += 1
+    stats["histogram"] = {
+        "bounds_ms": list(HISTOGRAM_BOUNDS_MS),
+        "counts": histogram,
+    }
+    return stats
+
+
+def summarize(samples, elapsed):
+    """Aggregate raw samples into the report's summary section."""
+    errors = {}
+    for sample in samples:
+        if sample["error"] is not None:
+            errors[sample["error"]] = errors.get(sample["error"], 0) + 1
+    total = len(samples)
+    ok = total - sum(errors.values())
+    return {
+        "requests": total,
+        "ok": ok,
+        "throughput_rps": ok / elapsed if elapsed else 0.0,
+        "error_rate": (total - ok) / total if total else 0.0,
+        "timeouts": errors.get("timeout", 0),
+        "errors": errors,
+        "latency_ms": latency_stats(samples),
+    }
+
+
+def build_report(options, clips, samples, elapsed):
+    """Build the JSON-serialisable report for one run."""
+    per_clip = {}
+    for clip in clips:
+        clip_samples = [s for s in samples if s["clip"] == clip["name"]]
+        per_clip[clip["name"]] = summarize(clip_samples, elapsed)
+    return {
+        "label": options.label or os.path.basename(options.output or "run"),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "url": options.url,
+            "mode": "rps" if options.rps else "concurrency",
+            "rps": options.rps,
+            "concurrency": options.concurrency,
+            "duration": options.duration,
+            "timeout": options.timeout,
+            "clips": {clip["name"]: clip["weight"] for clip in clips},
+        },
+        "summary": summarize(samples, elapsed),
+        "per_clip": per_clip,
+    }
+
+
+def lookup(report, dotted):
+    """Fetch a dotted metric such as ``latency_ms.p95`` from a report summary."""
+    value = report["summary"]
+    for key in dotted.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(reports):
+    """Return a text table of key metrics, with deltas against the first run."""
+    width = max(len(metric) for metric in COMPARE_METRICS)
+    lines = [
+        " ".join([f"{'metric':<{width}}"] + [f"{r['label']:>22}" for r in reports])
+    ]
+    for metric in COMPARE_METRICS:
+        base = lookup(reports[0], metric)
+        cells = []
+        for report in reports:
+            value = lookup(report, metric)
+            if value is None:
+                cells.append(f"{'-':>22}")
+                continue
+            cell = f"{value:.3f}" if isinstance(value, float) else str(value)
+            if report is not reports[0] and base:
+                cell += f" ({(value - base) / base:+.1%})"
+            cells.append(f"{cell:>22}")
+        lines.append(" ".join([f"{metric:<{width}}"] + cells))
+    return "\n".join(lines)
+
+
+def print_summary(report):
+    """Print a short human-readable summary of a report."""
+    summary = report["summary"]
+    latency = summary["latency_ms"]
+    print(
+        f"{summary['requests']} requests, {summary['throughput_rps']:.2f} ok/s, "
+        f"error rate {summary['error_rate']:.2%}, {summary['timeouts']} timeouts"
+    )
+    if latency:
+        print(
+            "latency ms: "
+            + ", ".join(f"p{pct}={latency[f'p{pct}']:.1f}" for pct in PERCENTILES)
+            + f", max={latency['max']:.1f}"
+        )
+    if summary["errors"]:
+        print(f"errors: {summary['errors']}")
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n", maxsplit=1)[0]
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="generate load and write a report")
+    run.add_argument("--url", default="http://localhost:8000/upload")
+    run.add_argument(
+        "--clip",
+        action="append",
+        required=True,
+        help="audio path or synth:<wav|webm|ogg>:<seconds>, optionally @weight",
+    )
+    mode = run.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--rps", type=float, help="open-loop target request rate")
+    mode.add_argument("--concurrency", type=int, help="closed-loop client count")
+    run.add_argument("--duration", type=float, default=30.0, help="seconds")
+    run.add_argument("--timeout", type=float, default=60.0, help="per request")
+    run.add_argument("--output", help="where to write the JSON report")
+    run.add_argument("--label", help="name shown when comparing reports")
+
+    cmp_parser = commands.add_parser("compare", help="compare saved reports")
+    cmp_parser.add_argument("reports", nargs="+")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    options = parse_args(argv)
+    if options.command == "compare":
+        reports = []
+        for path in options.reports:
+            with open(path, encoding="utf-8") as handle:
+                reports.append(json.load(handle))
+        print(compare(reports))
+        return 0
+
+    clips = [load_clip(spec) for spec in options.clip]
+    begin = time.monotonic()
+    if options.rps:
+        samples = run_open_loop(
+            options.url, clips, options.rps, options.duration, options.timeout
+        )
+    else:
+        samples = run_closed_loop(
+            options.url, clips, options.concurrency, options.duration, options.timeout
+        )
+    report = build_report(options, clips, samples, time.monotonic() - begin)
+    print_summary(report)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Tests for the load-testing harness.
+"""
+
+import io
+import json
+import os
+import sys
+import threading
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import loadtest  # pylint: disable=wrong-import-position
+
+
+class StubUploadHandler(BaseHTTPRequestHandler):
+    """Answers every upload like the web app, failing oversized clips."""
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Reply 200, or 503 when the body is larger than 100 kB."""
+        length = int(self.headers["Content-Length"])
+        self.rfile.read(length)
+        status = 503 if length > 100_000 else 200
+        body = json.dumps({"status": "success"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep test output quiet."""
+
+
+@pytest.fixture(name="upload_url")
+def fixture_upload_url():
+    """Serve StubUploadHandler on a free local port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubUploadHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/upload"
+    server.shutdown()
+
+
+def test_synthesize_wav_duration():
+    """Synthetic WAV clips have the requested length."""
+    data = loadtest.synthesize_wav(0.5)
+    with wave.open(io.BytesIO(data)) as reader:
+        assert reader.getnframes() == loadtest.SAMPLE_RATE // 2
+        assert reader.getframerate() == loadtest.SAMPLE_RATE
+
+
+def test_load_clip_spec(tmp_path):
+    """Clip specs accept files and synthetic clips with optional weights."""
+    path = tmp_path / "clip.wav"
+    path.write_bytes(b"RIFF")
+    clip = loadtest.load_clip(f"{path}@2.5")
+    assert clip["weight"] == 2.5
+    assert clip["content_type"] == "audio/wav"
+    assert loadtest.load_clip("synth:wav:0.1")["filename"] == "synthetic.wav"
+    with pytest.raises(ValueError):
+        loadtest.load_clip("synth:mp4:1")
+
+
+def test_percentile_nearest_rank():
+    """Nearest-rank percentiles pick an observed value."""
+    values = list(range(1, 101))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([7], 95) == 7
+
+
+def test_runs_record_errors_and_compare(upload_url):
+    """Both modes record latencies and errors, and reports compare."""
+    small = loadtest.load_clip("synth:wav:0.5")
+    large = loadtest.load_clip("synth:wav:4")
+    clips = [small, large]
+
+    samples = loadtest.run_closed_loop(upload_url, clips, 2, 0.3, 5)
+    summary = loadtest.summarize(samples, 0.3)
+    assert summary["requests"] == len(samples) > 0
+    assert set(summary["errors"]) <= {"http_503"}
+
+    samples = loadtest.run_open_loop(upload_url, [small], 50, 0.2, 5)
+    assert len(samples) == 10
+    summary = loadtest.summarize(samples, 0.2)
+    assert summary["error_rate"] == 0
+    assert sum(summary["latency_ms"]["histogram"]["counts"]) == 10
+
+    options = loadtest.parse_args(
+        ["run", "--clip", "x", "--rps", "50", "--label", "base"]
+    )
+    base = loadtest.build_report(options, [small], samples, 0.2)
+    other = json.loads(json.dumps(base))
+    other["label"] = "other"
+    other["summary"]["latency_ms"]["p95"] *= 2
+    table = loadtest.compare([base, other])
+    assert "latency_ms.p95" in table
+    assert "+100.0%" in table
+
+
+def test_send_reports_connection_errors():
+    """Unreachable targets count as connection errors, not crashes."""
+    clip = loadtest.load_clip("synth:wav:0.1")
+    sample = loadtest.send("http://127.0.0.1:9/upload", clip, 1)
+    assert sample["error"] in {"connection", "timeout"}
+    assert sample["status"] is None
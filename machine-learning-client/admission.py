@@ -0,0 +1,141 @@
+"""
+Admission control: per-client rate limits, a bounded inference queue and
+rejection counters.
+
+The web app keeps an identical copy of this module, since each service is
+built from its own directory.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Rejected(Exception):
+    """Raised when a request is refused; carries the HTTP status to return."""
+
+    def __init__(self, status, reason, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self):
+        """Response headers for the rejection."""
+        if self.retry_after is None:
+            return {}
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class Metrics:
+    """Thread-safe named counters, exposed as a JSON-friendly snapshot."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def increment(self, name, amount=1):
+        """Add ``amount`` to counter ``name``."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """Return a copy of all counters."""
+        with self._lock:
+            return dict(self._counters)
+
+
+class TokenBucketLimiter:  # pylint: disable=too-few-public-methods
+    """Per-client token buckets refilled at ``rate`` tokens per second.
+
+    A rate of zero or less disables limiting. Buckets that have been idle long
+    enough to refill completely are dropped once ``max_clients`` is exceeded.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def check(self, key):
+        """Take a token for ``key`` or raise :class:`Rejected` with status 429."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = self._clock()
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                raise Rejected(
+                    429,
+                    "rate_limited",
+                    "Too many requests",
+                    retry_after=(1 - tokens) / self.rate,
+                )
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_clients:
+                self._prune(now)
+
+    def _prune(self, now):
+        full_after = self.burst / self.rate
+        self._buckets = {
+            key: (tokens, last)
+            for key, (tokens, last) in self._buckets.items()
+            if now - last < full_after
+        }
+
+
+class AdmissionGate:  # pylint: disable=too-few-public-methods
+    """At most ``max_concurrent`` holders, with at most ``max_queue`` waiting.
+
+    Requests beyond the queue bound, or that wait longer than
+    ``queue_timeout`` seconds, are refused with status 503 instead of piling
+    up behind the running ones.
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+
+    @contextmanager
+    def slot(self):
+        """Hold one slot for the duration of the ``with`` block."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.max_queue:
+                    raise Rejected(
+                        503,
+                        "queue_full",
+                        "Server busy, try again later",
+                        retry_after=self.queue_timeout,
+                    )
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                raise Rejected(
+                    503,
+                    "queue_timeout",
+                    "Server busy, try again later",
+                    retry_after=self.queue_timeout,
+                )
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
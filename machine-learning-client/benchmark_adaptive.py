@@ -0,0 +1,109 @@
+"""
+Benchmark adaptive (early-exit) inference against full-length inference.
+
+For every file the full-length prediction is taken as the reference, then the
+adaptive mode is run at each confidence threshold. The report shows how much
+audio and wall time adaptive inference saved and how often its label agreed
+with the full-length one.
+
+Example:
+    python benchmark_adaptive.py /data/audio --thresholds 0.7 0.8 0.9 0.95
+"""
+
+import argparse
+import sys
+import time
+
+from bulk_rescore import discover_files
+from emotion_analyzer import (
+    classify_windowed,
+    classify_full,
+    load_audio,
+    load_classifier,
+)
+from inference_planner import SAMPLE_RATE
+
+
+def benchmark_file(classifier, path, window_seconds, thresholds):
+    """Run full and adaptive inference on one file.
+
+    Returns ``(full, adaptive)`` where ``full`` is a ``(label, seconds)`` pair
+    and ``adaptive`` maps each threshold to ``(label, seconds, fraction)``,
+    ``fraction`` being the share of samples the encoder processed.
+    """
+    waveform = load_audio(path)
+    total = waveform.shape[-1]
+
+    start = time.perf_counter()
+    full_label, _, _ = classify_full(classifier, waveform)
+    full = (full_label, time.perf_counter() - start)
+
+    adaptive = {}
+    window = max(int(window_seconds * SAMPLE_RATE), 1)
+    for threshold in thresholds:
+        start = time.perf_counter()
+        label, _, processed = classify_windowed(classifier, waveform, window, threshold)
+        adaptive[threshold] = (label, time.perf_counter() - start, processed / total)
+    return full, adaptive
+
+
+def summarize(results, thresholds):
+    """Aggregate per-file results into one row per threshold."""
+    full_time = sum(full[1] for full, _ in results)
+    rows = []
+    for threshold in thresholds:
+        runs = [(full, adaptive[threshold]) for full, adaptive in results]
+        agree = sum(full[0] == run[0] for full, run in runs)
+        adaptive_time = sum(run[1] for _, run in runs)
+        rows.append(
+            {
+                "threshold": threshold,
+                "agreement": agree / len(runs),
+                "audio_processed": sum(run[2] for _, run in runs) / len(runs),
+                "time_saved": 1 - adaptive_time / full_time if full_time else 0.0,
+            }
+        )
+    return rows
+
+
+def format_rows(rows):
+    """Render summary rows as a text table."""
+    lines = [f"{'threshold':>9} {'agreement':>9} {'audio used':>10} {'time saved':>10}"]
+    for row in rows:
+        lines.append(
+            f"{row['threshold']:>9.2f} {row['agreement']:>9.1%} "
+            f"{row['audio_processed']:>10.1%} {row['time_saved']:>10.1%}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n", maxsplit=1)[0]
+    )
+    parser.add_argument("source", nargs="?", default=".", help="directory to walk")
+    parser.add_argument("--manifest", help="file listing one audio path per line")
+    parser.add_argument("--window-seconds", type=float, default=3.0)
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.7, 0.8, 0.9, 0.95]
+    )
+    options = parser.parse_args(argv)
+
+    paths = discover_files(options.source, options.manifest)
+    if not paths:
+        print("No audio files found", file=sys.stderr)
+        return 1
+    classifier = load_classifier()
+    results = []
+    for path in paths:
+        results.append(
+            benchmark_file(classifier, path, options.window_seconds, options.thresholds)
+        )
+    print(f"{len(results)} files")
+    print(format_rows(summarize(results, options.thresholds)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
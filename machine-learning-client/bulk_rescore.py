@@ -0,0 +1,331 @@
+"""
+Offline bulk re-scoring of audio with the emotion model.
+
+Walks a directory (or reads a manifest of paths), decodes files in a process
+pool, groups them into length buckets, runs batched inference and upserts the
+results into ``sound_result`` tagged with a model version. Progress is
+checkpointed so an interrupted run can be resumed, and
+``--num-shards``/``--shard-index`` split the work across machines.
+
+Example:
+    python bulk_rescore.py /data/audio --model-version wav2vec2-iemocap-v2
+"""
+
+import argparse
+import itertools
+import os
+import re
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import pymongo
+import torch
+
+from emotion_analyzer import (
+    classify_batch,
+    classify_windowed,
+    decode_labels,
+    load_audio,
+    load_classifier,
+)
+from inference_planner import (
+    MEMORY_BUDGET,
+    bucket_by_length,
+    estimate_peak_bytes,
+    max_chunk_samples,
+)
+
+AUDIO_EXTENSIONS = (".wav", ".webm", ".ogg", ".mp3", ".flac", ".m4a")
+# Decoded clips are pooled this many batches deep before being bucketed by
+# length, so each batch holds clips of similar length.
+BUCKET_POOL_BATCHES = 4
+
+
+def discover_files(source, manifest=None):
+    """Return the sorted list of audio paths to score.
+
+    If ``manifest`` is given it is read as one path per line (blank lines and
+    ``#`` comments are ignored); otherwise ``source`` is walked recursively.
+    """
+    if manifest:
+        with open(manifest, encoding="utf-8") as handle:
+            lines = (line.strip() for line in handle)
+            return sorted(line for line in lines if line and not line.startswith("#"))
+
+    paths = []
+    for root, _, files in os.walk(source):
+        for name in files:
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def source_key(path, source):
+    """Identify a file by its path relative to ``source``.
+
+    Shards, checkpoint entries and stored ``source`` fields use this key, so
+    machines that mount the corpus at different roots agree on all three.
+    """
+    return os.path.relpath(path, source)
+
+
+def in_shard(key, shard_index, num_shards):
+    """Stable assignment of a file key to one of ``num_shards`` shards."""
+    return zlib.crc32(key.encode("utf-8")) % num_shards == shard_index
+
+
+def load_checkpoint(checkpoint_path):
+    """Return the set of file keys already recorded as done in the checkpoint."""
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, encoding="utf-8") as handle:
+        return {line.rstrip("\n") for line in handle if line.strip()}
+
+
+def append_checkpoint(checkpoint_path, keys):
+    """Record ``keys`` as done; flushed so a crash loses at most one batch."""
+    with open(checkpoint_path, "a", encoding="utf-8") as handle:
+        for key in keys:
+            handle.write(f"{key}\n")
+        handle.flush()
+        os.fsync(handle.fileno())
+
+
+def decode_file(path):
+    """Load a file as a 1-D waveform with :func:`emotion_analyzer.load_audio`.
+
+    Runs inside the worker processes. A file that decodes to no samples (e.g.
+    a header-only WAV) is reported as an error.
+    Returns ``(path, waveform, error)``; exactly one of the last two is set.
+    """
+    try:
+        waveform = load_audio(path)[0]
+        if waveform.shape[-1] == 0:
+            return path, None, "Audio file contains no samples"
+        return path, waveform, None
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return path, None, str(error)
+
+
+def pad_batch(waveforms):
+    """Zero-pad 1-D waveforms into ``[batch, time]`` plus relative lengths."""
+    lengths = [waveform.shape[0] for waveform in waveforms]
+    longest = max(lengths)
+    wavs = torch.zeros(len(waveforms), longest)
+    for row, waveform in enumerate(waveforms):
+        wavs[row, : lengths[row]] = waveform
+    wav_lens = torch.tensor([length / longest for length in lengths])
+    return wavs, wav_lens
+
+
+def score_batch(classifier, waveforms, chunk=None):
+    """Classify a list of waveforms, returning ``(label, confidence)`` pairs.
+
+    A single waveform longer than ``chunk`` samples is encoded chunk by chunk.
+    """
+    if len(waveforms) == 1 and chunk and waveforms[0].shape[-1] > chunk:
+        label, confidence, _ = classify_windowed(
+            classifier, waveforms[0].unsqueeze(0), chunk
+        )
+        return [(label, confidence)]
+    wavs, wav_lens = pad_batch(waveforms)
+    probs = classify_batch(classifier, wavs, wav_lens)
+    return decode_labels(classifier, probs)
+
+
+def write_results(collection, model_version, keys, predictions):
+    """Upsert one ``sound_result`` document per file key in a single bulk write."""
+    now = datetime.now(timezone.utc)
+    operations = [
+        pymongo.UpdateOne(
+            {"source": key, "model_version": model_version},
+            {
+                "$set": {
+                    "emotion": label,
+                    "confidence": confidence,
+                    "timestamp": now,
+                }
+            },
+            upsert=True,
+        )
+        for key, (label, confidence) in zip(keys, predictions)
+    ]
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+
+def bounded_map(executor, func, items, max_in_flight):
+    """Like ``executor.map``, but with at most ``max_in_flight`` results pending.
+
+    ``executor.map`` submits every item up front, so fast workers would pile
+    up results faster than the caller consumes them. Here a new item is only
+    submitted as each result is taken. Results come back in input order.
+    """
+    items = iter(items)
+    futures = deque(
+        executor.submit(func, item)
+        for item in itertools.islice(items, max(max_in_flight, 1))
+    )
+    while futures:
+        yield futures.popleft().result()
+        for item in itertools.islice(items, 1):
+            futures.append(executor.submit(func, item))
+
+
+def iter_decoded(paths, workers, max_in_flight):
+    """Yield decoded files in order, using a process pool when ``workers > 1``."""
+    if workers <= 1:
+        yield from map(decode_file, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from bounded_map(executor, decode_file, paths, max_in_flight)
+
+
+def plan_batches(lengths, batch_size, chunk, budget):
+    """Split pooled clips into batches: overlong clips alone, the rest bucketed."""
+    overlong = [[index] for index, length in enumerate(lengths) if length > chunk]
+    rest = [index for index, length in enumerate(lengths) if length <= chunk]
+    buckets = bucket_by_length([lengths[index] for index in rest], batch_size, budget)
+    return overlong + [[rest[index] for index in bucket] for bucket in buckets]
+
+
+def partition_paths(paths, options):
+    """Split ``paths`` into ``(pending, resumed, other_shards)``.
+
+    ``resumed`` counts this shard's paths the checkpoint lists as done and
+    ``other_shards`` the paths assigned to other shards. Both are decided by
+    :func:`source_key`.
+    """
+    done = load_checkpoint(options.checkpoint)
+    pending = []
+    resumed = other_shards = 0
+    for path in paths:
+        key = source_key(path, options.source)
+        if not in_shard(key, options.shard_index, options.num_shards):
+            other_shards += 1
+        elif key in done:
+            resumed += 1
+        else:
+            pending.append(path)
+    return pending, resumed, other_shards
+
+
+def run_rescore(
+    paths, collection, classifier, options
+):  # pylint: disable=too-many-locals
+    """Score ``paths`` in batches, writing results and checkpointing progress.
+
+    ``options`` is the parsed argument namespace. Returns a summary dict with
+    ``scored``, ``failed``, ``resumed`` (already in the checkpoint),
+    ``other_shards`` and ``files_per_sec``.
+    """
+    pending, resumed, other_shards = partition_paths(paths, options)
+    summary = {
+        "scored": 0,
+        "failed": 0,
+        "resumed": resumed,
+        "other_shards": other_shards,
+    }
+    start = time.monotonic()
+    budget = MEMORY_BUDGET.available()
+    chunk = max_chunk_samples(budget)
+    pool = []
+
+    def flush(batch):
+        keys = [source_key(path, options.source) for path, _ in batch]
+        waveforms = [waveform for _, waveform in batch]
+        longest = max(waveform.shape[-1] for waveform in waveforms)
+        with MEMORY_BUDGET.reserve(
+            estimate_peak_bytes(min(longest, chunk), len(batch))
+        ):
+            predictions = score_batch(classifier, waveforms, chunk)
+        write_results(collection, options.model_version, keys, predictions)
+        append_checkpoint(options.checkpoint, keys)
+        summary["scored"] += len(batch)
+        elapsed = max(time.monotonic() - start, 1e-9)
+        print(
+            f"Scored {summary['scored']}/{len(pending)} files "
+            f"({summary['scored'] / elapsed:.2f} files/sec)"
+        )
+
+    def flush_pool():
+        lengths = [waveform.shape[-1] for _, waveform in pool]
+        for indices in plan_batches(lengths, options.batch_size, chunk, budget):
+            flush([pool[index] for index in indices])
+        pool.clear()
+
+    # Bound decoding to what the pools of all workers can hold, so decoded
+    # waveforms never pile up ahead of inference.
+    pool_size = options.batch_size * BUCKET_POOL_BATCHES
+    for path, waveform, error in iter_decoded(
+        pending, options.workers, options.workers * pool_size
+    ):
+        if error is not None:
+            summary["failed"] += 1
+            print(f"Skipping {path}: {error}", file=sys.stderr)
+            continue
+        pool.append((path, waveform))
+        if len(pool) >= pool_size:
+            flush_pool()
+    flush_pool()
+
+    summary["files_per_sec"] = summary["scored"] / max(time.monotonic() - start, 1e-9)
+    return summary
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n", maxsplit=1)[0]
+    )
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=".",
+        help="directory to walk; results are keyed by paths relative to it",
+    )
+    parser.add_argument("--manifest", help="file listing one audio path per line")
+    parser.add_argument("--model-version", required=True)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--checkpoint", help="progress file (default: per shard)")
+    parser.add_argument(
+        "--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://mongodb:27017/")
+    )
+    options = parser.parse_args(argv)
+    if not 0 <= options.shard_index < options.num_shards:
+        parser.error("--shard-index must be in [0, --num-shards)")
+    if options.checkpoint is None:
+        # Versions such as "speechbrain/emotion-v2" must not become directories.
+        version = re.sub(r"[^A-Za-z0-9._-]", "_", options.model_version)
+        options.checkpoint = (
+            f"rescore-{version}-{options.shard_index}of{options.num_shards}.ckpt"
+        )
+    return options
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    options = parse_args(argv)
+    paths = discover_files(options.source, options.manifest)
+    print(f"Found {len(paths)} files; loading model...")
+    classifier = load_classifier()
+    collection = pymongo.MongoClient(options.mongo_uri)["emmmm"].sound_result
+    summary = run_rescore(paths, collection, classifier, options)
+    print(
+        f"Done: {summary['scored']} scored, {summary['failed']} failed, "
+        f"{summary['resumed']} already done, "
+        f"{summary['other_shards']} in other shards "
+        f"({summary['files_per_sec']:.2f} files/sec)"
+    )
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,180 @@
 """Analyze audio emotion by using pre-trained model"""
 
+import os
+import threading
+import time
+import wave
+import zlib
+
 import torch
 import torch.nn.functional as F
 import torchaudio
 
 from speechbrain.inference import EncoderClassifier
 
+from inference_planner import (
+    ENCODER_CHUNK_SECONDS,
+    MEMORY_BUDGET,
+    SAMPLE_RATE,
+    estimate_peak_bytes,
+    max_chunk_samples,
+)
 
-def analyze_emotion(file_path):
-    """Apply the third party pre-trained model to analyze the audio."""
-    print("Loading model...")
-    classifier = EncoderClassifier.from_hparams(
-        source="speechbrain/emotion-recognition-wav2vec2-IEMOCAP",
-        savedir="pretrained_models/emotion-recognition",
-    )
+MODEL_SOURCE = "speechbrain/emotion-recognition-wav2vec2-IEMOCAP"
+MODEL_SAVEDIR = "pretrained_models/emotion-recognition"
 
-    classifier.hparams.label_encoder.expect_len(4)
-    print("Loading audio...")
-    waveform, _ = torchaudio.load(file_path)
-    print("Extracting features with wav2vec2...")
+# Set EMOTION_MODEL=stub to skip the real model, e.g. when load testing the
+# stack; STUB_LATENCY_MS plus STUB_LATENCY_MS_PER_SECOND for every second of
+# audio then emulate inference time.
+STUB_LABELS = ("neu", "ang", "hap", "sad")
+
+
+class AudioTooLong(ValueError):
+    """Raised when decoded audio is longer than the caller's limit."""
+
+    def __init__(self, seconds, limit):
+        super().__init__(f"Audio is {seconds:.1f}s; the limit is {limit:g}s")
+        self.seconds = seconds
+        self.limit = limit
+
+
+_classifier = None  # pylint: disable=invalid-name
+_classifier_lock = threading.Lock()
+
+
+def load_classifier():
+    """Return the pre-trained emotion classifier, loading it once per process.
+
+    Every inference shares the one copy of the weights. Loading happens before
+    any memory reservation, so the weights are part of the RSS baseline the
+    memory budget measures.
+    """
+    global _classifier  # pylint: disable=global-statement
+    with _classifier_lock:
+        if _classifier is None:
+            classifier = EncoderClassifier.from_hparams(
+                source=MODEL_SOURCE,
+                savedir=MODEL_SAVEDIR,
+            )
+            classifier.hparams.label_encoder.expect_len(4)
+            _classifier = classifier
+        return _classifier
 
+
+def classify_batch(classifier, wavs, wav_lens=None):
+    """Return class probabilities for a padded batch of waveforms.
+
+    ``wavs`` has shape ``[batch, time]`` and ``wav_lens`` holds each
+    waveform's length relative to the longest one, as SpeechBrain expects.
+    """
+    with torch.no_grad():
+        wav2vec_out = classifier.mods.wav2vec2(wavs, wav_lens)
+        pooled = classifier.mods.avg_pool(wav2vec_out, wav_lens)
+        logits = classifier.mods.output_mlp(pooled)
+        logits = logits.view(logits.shape[0], -1)
+        return F.softmax(logits, dim=-1)
+
+
+def decode_labels(classifier, probs):
+    """Turn a batch of probabilities into ``(label, confidence)`` pairs."""
+    confidences, indices = torch.max(probs, dim=-1)
+    encoder = classifier.hparams.label_encoder
+    return [
+        (encoder.decode_ndim(torch.tensor(index)), confidence)
+        for index, confidence in zip(indices.tolist(), confidences.tolist())
+    ]
+
+
+def load_audio(path):
+    """Load a file as a mono waveform of shape ``[1, time]`` at 16 kHz.
+
+    Live inference, bulk re-scoring and the benchmark all decode through here,
+    so the model sees the same input for the same file on every path.
+    """
+    waveform, sample_rate = torchaudio.load(path)
+    if waveform.shape[0] > 1:
+        waveform = waveform.mean(dim=0, keepdim=True)
+    if sample_rate != SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, sample_rate, SAMPLE_RATE)
+    return waveform
+
+
+def audio_duration(path):
+    """Read the duration in seconds from the file header, without decoding.
+
+    Returns None when the container does not record its length up front
+    (e.g. browser-recorded webm) or the header claims a zero sample rate.
+    """
+    try:
+        with wave.open(path, "rb") as reader:
+            rate = reader.getframerate()
+            return reader.getnframes() / rate if rate else None
+    except (wave.Error, EOFError):
+        pass
+    try:
+        info = torchaudio.info(path)
+        if info.num_frames and info.sample_rate:
+            return info.num_frames / info.sample_rate
+    except Exception:  # pylint: disable=broad-exception-caught
+        pass
+    return None
+
+
+def stub_duration(path):
+    """Duration for the stub model: from the header, else by decoding.
+
+    Returns None for files that cannot be decoded.
+    """
+    duration = audio_duration(path)
+    if duration is not None:
+        return duration
+    try:
+        return load_audio(path).shape[-1] / SAMPLE_RATE
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
+
+
+def stub_emotion(file_path, duration=None):
+    """Return a deterministic label derived from the file bytes, without a model.
+
+    Sleeps for a fixed latency plus a per-second latency times ``duration``,
+    so longer clips keep the stub busy for longer, as they do the real model.
+    """
+    latency_ms = float(os.environ.get("STUB_LATENCY_MS", "0")) + float(
+        os.environ.get("STUB_LATENCY_MS_PER_SECOND", "0")
+    ) * (duration or 0)
+    time.sleep(latency_ms / 1000)
+    with open(file_path, "rb") as audio_file:
+        checksum = zlib.crc32(audio_file.read())
+    return STUB_LABELS[checksum % len(STUB_LABELS)]
+
+
+def window_bounds(num_samples, window):
+    """Split ``num_samples`` into ``(start, end)`` windows of at most ``window``.
+
+    A tail shorter than half a window is evened out with the window before it,
+    so the encoder never sees a clip too short for its convolutional front end
+    and no window grows past ``window``.
+    """
+    bounds = [
+        (start, min(start + window, num_samples))
+        for start in range(0, num_samples, window)
+    ]
+    if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] < window // 2:
+        start, end = bounds[-2][0], bounds.pop()[1]
+        middle = (start + end) // 2
+        bounds[-1:] = [(start, middle), (middle, end)]
+    return bounds
+
+
+def classify_full(classifier, waveform):
+    """Classify the whole waveform in one forward pass.
+
+    Channels are mixed down first, as in :func:`classify_windowed`, so a
+    stereo clip gets the same prediction whichever path it takes.
+    """
+    samples = waveform.shape[-1]
+    waveform = waveform.mean(dim=0, keepdim=True)
     with torch.no_grad():
         wav2vec_out = classifier.mods.wav2vec2(waveform)
         pooled = classifier.mods.avg_pool(wav2vec_out)
@@ -29,5 +184,102 @@ def analyze_emotion(file_path):
     top_index = torch.argmax(probs).item()
     label = classifier.hparams.label_encoder.decode_ndim(torch.tensor(top_index))
     confidence = probs[top_index].item()
+    return label, confidence, samples
+
+
+def classify_windowed(classifier, waveform, window, threshold=None):
+    """Classify window by window, pooling the encoder outputs.
+
+    Each window is encoded on its own and its pooled embedding folded into a
+    length-weighted running mean, so the prediction after the last window
+    covers the whole clip while peak memory only depends on ``window``. With
+    a ``threshold`` this is adaptive inference: the first window is the
+    clip's prefix, and classification stops as soon as the confidence of the
+    running prediction reaches the threshold.
+    Returns ``(label, confidence, samples_processed)``.
+    """
+    waveform = waveform.mean(dim=0, keepdim=True)
+    if waveform.shape[-1] == 0:
+        raise ValueError("Audio file contains no samples")
+    pooled_sum = None
+    processed = 0
+    with torch.no_grad():
+        for start, end in window_bounds(waveform.shape[-1], window):
+            chunk = waveform[:, start:end]
+            pooled = classifier.mods.avg_pool(classifier.mods.wav2vec2(chunk))
+            weighted = pooled * (end - start)
+            pooled_sum = weighted if pooled_sum is None else pooled_sum + weighted
+            processed += end - start
+            logits = classifier.mods.output_mlp(pooled_sum / processed)
+            confidence, index = torch.max(F.softmax(logits.view(-1), dim=0), dim=0)
+            if threshold is not None and confidence.item() >= threshold:
+                break
+    label = classifier.hparams.label_encoder.decode_ndim(torch.tensor(index.item()))
+    return label, confidence.item(), processed
+
+
+def analyze_emotion(
+    file_path, adaptive=None, return_details=False, max_seconds=None, timeout=None
+):
+    """Apply the third party pre-trained model to analyze the audio.
+
+    With ``adaptive`` (default: the ADAPTIVE_INFERENCE environment variable)
+    the clip is classified window by window and stops early once the model is
+    confident; see :func:`classify_windowed`. Clips longer than the memory
+    planner's chunk size are always encoded in chunks. With ``return_details``
+    a dict is returned that also reports how much of the audio was processed.
+    With ``max_seconds`` the decoded length is checked before the encoder
+    runs, raising :class:`AudioTooLong`; this covers formats such as webm
+    whose header does not record a duration. ``timeout`` bounds the wait for
+    room in the memory budget; ``TimeoutError`` is raised when it runs out.
+    """
+    if os.environ.get("EMOTION_MODEL") == "stub":
+        duration = stub_duration(file_path)
+        label = stub_emotion(file_path, duration)
+        if not return_details:
+            return label
+        return {
+            "emotion": label,
+            "confidence": None,
+            "audio_seconds": duration,
+            "processed_seconds": duration,
+            "early_exit": False,
+        }
+    if adaptive is None:
+        adaptive = os.environ.get("ADAPTIVE_INFERENCE", "0") == "1"
+    print("Loading model...")
+    classifier = load_classifier()
+    print("Loading audio...")
+    waveform = load_audio(file_path)
+    total = waveform.shape[-1]
+    if max_seconds and total / SAMPLE_RATE > max_seconds:
+        raise AudioTooLong(total / SAMPLE_RATE, max_seconds)
+    print("Extracting features with wav2vec2...")
+
+    chunk = max_chunk_samples(
+        MEMORY_BUDGET.available(), int(ENCODER_CHUNK_SECONDS * SAMPLE_RATE)
+    )
+    threshold = None
+    if adaptive:
+        window = int(
+            float(os.environ.get("ADAPTIVE_WINDOW_SECONDS", "3")) * SAMPLE_RATE
+        )
+        chunk = min(chunk, max(window, 1))
+        threshold = float(os.environ.get("ADAPTIVE_CONFIDENCE", "0.9"))
+    with MEMORY_BUDGET.reserve(estimate_peak_bytes(min(total, chunk)), timeout):
+        if adaptive or total > chunk:
+            label, confidence, processed = classify_windowed(
+                classifier, waveform, chunk, threshold
+            )
+        else:
+            label, confidence, processed = classify_full(classifier, waveform)
     print(f"Detected Emotion: {label} (probability: {confidence:.4f})")
-    return label
+    if not return_details:
+        return label
+    return {
+        "emotion": label,
+        "confidence": confidence,
+        "audio_seconds": total / SAMPLE_RATE,
+        "processed_seconds": processed / SAMPLE_RATE,
+        "early_exit": processed < total,
+    }
@@ -0,0 +1,171 @@
+"""
+Memory-aware planning for wav2vec2 inference.
+
+Self-attention makes the encoder's memory grow with the square of the input
+length, so a single long upload can dwarf everything else in the process.
+This module estimates peak memory from the sample count, picks a chunk size
+that fits a memory ceiling, groups queued clips into length buckets to keep
+padding low, and tracks a process-wide memory budget that inferences reserve
+from before they run.
+
+Configured with MEMORY_CEILING_MB (0 disables the ceiling) and
+ENCODER_CHUNK_SECONDS, the longest input given to the encoder in one piece.
+"""
+
+import os
+import resource
+import threading
+from contextlib import contextmanager
+
+# Shape of the wav2vec2-base encoder used by the IEMOCAP model.
+FRAME_STRIDE = 320  # samples per encoder frame
+CONV_CHANNELS = 512
+FIRST_CONV_STRIDE = 5
+HIDDEN_SIZE = 768
+FFN_SIZE = 3072
+ATTENTION_HEADS = 12
+FLOAT_BYTES = 4
+# Fixed per-call overhead on top of the model weights (allocator slack etc.).
+BASE_OVERHEAD_BYTES = 64 * 1024 * 1024
+
+SAMPLE_RATE = 16000
+ENCODER_CHUNK_SECONDS = float(os.environ.get("ENCODER_CHUNK_SECONDS", "30"))
+MEMORY_CEILING_BYTES = int(float(os.environ.get("MEMORY_CEILING_MB", "0")) * 2**20)
+# Smallest chunk worth encoding: shorter inputs give the encoder almost no
+# context, so below this the planner stops shrinking chunks.
+MIN_CHUNK_SAMPLES = SAMPLE_RATE
+
+
+def estimate_peak_bytes(num_samples, batch_size=1):
+    """Rough peak memory of one no-grad forward pass over padded inputs.
+
+    Counts the input, the first convolution's output (the largest tensor in
+    the feature extractor), one layer's attention scores and softmax, and one
+    layer's feed-forward activations; layers run one after another, so only
+    one layer's temporaries are alive at a time.
+    """
+    frames = num_samples // FRAME_STRIDE + 1
+    per_item = (
+        num_samples
+        + 2 * CONV_CHANNELS * (num_samples // FIRST_CONV_STRIDE)
+        + 2 * ATTENTION_HEADS * frames * frames
+        + 2 * frames * (FFN_SIZE + 2 * HIDDEN_SIZE)
+    ) * FLOAT_BYTES
+    return BASE_OVERHEAD_BYTES + batch_size * per_item
+
+
+def max_chunk_samples(budget_bytes, limit=None):
+    """Longest single input whose estimate fits ``budget_bytes``.
+
+    Never exceeds ``limit`` (default: ENCODER_CHUNK_SECONDS at 16 kHz) and,
+    however small the budget, never goes below MIN_CHUNK_SAMPLES unless
+    ``limit`` itself is smaller.
+    """
+    if limit is None:
+        limit = int(ENCODER_CHUNK_SECONDS * SAMPLE_RATE)
+    if budget_bytes is None or estimate_peak_bytes(limit) <= budget_bytes:
+        return limit
+    low, high = min(MIN_CHUNK_SAMPLES, limit), limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_peak_bytes(middle) <= budget_bytes:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def bucket_by_length(lengths, max_batch_size, max_batch_bytes=None, max_padding=0.25):
+    """Group item indices into batches of similar length.
+
+    Items are sorted by length and added to the current batch while it stays
+    within ``max_batch_size``, its padded estimate stays within
+    ``max_batch_bytes``, and the share of padding stays within
+    ``max_padding``. Returns a list of index lists.
+    """
+    batches = []
+    batch, total = [], 0
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+        length = lengths[index]
+        if batch:
+            count = len(batch) + 1
+            # Sorted order means an empty clip only ever joins empty clips.
+            padding = 1 - (total + length) / (count * length) if length else 0.0
+            fits = max_batch_bytes is None or (
+                estimate_peak_bytes(length, count) <= max_batch_bytes
+            )
+            if count > max_batch_size or padding > max_padding or not fits:
+                batches.append(batch)
+                batch, total = [], 0
+        batch.append(index)
+        total += length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def current_rss_bytes():
+    """Resident set size of this process; peak RSS where /proc is missing."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+    """Process-wide budget that inferences reserve their estimate from.
+
+    The process's RSS is sampled whenever nothing is reserved and taken as the
+    baseline; reservations are admitted while baseline plus reserved bytes
+    stay under ``ceiling_bytes``, otherwise they wait. A ceiling of zero
+    disables the budget.
+    """
+
+    def __init__(self, ceiling_bytes, rss=current_rss_bytes):
+        self.ceiling_bytes = ceiling_bytes
+        self._rss = rss
+        self._condition = threading.Condition()
+        self.reserved = 0
+        self.baseline = 0
+
+    def available(self):
+        """Bytes one inference may use with nothing else reserved, or None."""
+        if self.ceiling_bytes <= 0:
+            return None
+        with self._condition:
+            if self.reserved == 0:
+                self.baseline = self._rss()
+            return max(self.ceiling_bytes - self.baseline, 0)
+
+    @contextmanager
+    def reserve(self, nbytes, timeout=None):
+        """Hold ``nbytes`` of the budget for the ``with`` block.
+
+        A request larger than the whole budget is admitted only when nothing
+        else is reserved, so it runs alone rather than never. Raises
+        ``TimeoutError`` if the bytes do not free up within ``timeout``.
+        """
+        if self.ceiling_bytes <= 0:
+            yield
+            return
+        with self._condition:
+            if self.reserved == 0:
+                self.baseline = self._rss()
+            admitted = self._condition.wait_for(
+                lambda: self.reserved == 0
+                or self.baseline + self.reserved + nbytes <= self.ceiling_bytes,
+                timeout,
+            )
+            if not admitted:
+                raise TimeoutError("Timed out waiting for inference memory")
+            self.reserved += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved -= nbytes
+                self._condition.notify_all()
+
+
+MEMORY_BUDGET = MemoryBudget(MEMORY_CEILING_BYTES)
@@ -1,7 +1,11 @@
 from flask import Flask, request, jsonify
-from emotion_analyzer import analyze_emotion
+from emotion_analyzer import AudioTooLong, analyze_emotion, audio_duration
+from admission import AdmissionGate, Metrics, Rejected, TokenBucketLimiter
 from datetime import datetime, timezone
+import ipaddress
 import os
+import socket
+import time
 import pymongo
 import tempfile
 
@@ -10,6 +14,124 @@ mongo_uri = os.environ.get("MONGO_URI", "mongodb://mongodb:27017/")
 client = pymongo.MongoClient(mongo_uri)
 db = client["emmmm"]
 
+# Admission control; see admission.py. Zero disables the duration limit and
+# the per-client rate limit.
+MAX_AUDIO_SECONDS = float(os.environ.get("MAX_AUDIO_SECONDS", "120"))
+METRICS = Metrics()
+RATE_LIMITER = TokenBucketLimiter(
+    rate=float(os.environ.get("RATE_LIMIT_PER_SECOND", "1")),
+    burst=float(os.environ.get("RATE_LIMIT_BURST", "10")),
+)
+INFERENCE_GATE = AdmissionGate(
+    max_concurrent=int(os.environ.get("MAX_CONCURRENT_INFERENCES", "2")),
+    max_queue=int(os.environ.get("MAX_QUEUED_REQUESTS", "8")),
+    queue_timeout=float(os.environ.get("QUEUE_TIMEOUT_SECONDS", "30")),
+)
+# Callers whose X-Forwarded-For header is believed: comma-separated
+# addresses, networks or host names. Defaults to the compose web service.
+TRUSTED_PROXIES = tuple(
+    entry.strip()
+    for entry in os.environ.get("TRUSTED_PROXIES", "web").split(",")
+    if entry.strip()
+)
+# Host name lookups are cached this long, so a restarted proxy is picked up.
+PROXY_DNS_TTL_SECONDS = 60
+_proxy_addresses = {}
+
+
+def proxy_addresses(entry):
+    """Return the addresses a trusted proxy entry stands for."""
+    try:
+        return [ipaddress.ip_network(entry, strict=False)]
+    except ValueError:
+        pass
+    expires, addresses = _proxy_addresses.get(entry, (0, []))
+    if time.monotonic() >= expires:
+        try:
+            addresses = [
+                ipaddress.ip_network(address)
+                for address in socket.gethostbyname_ex(entry)[2]
+            ]
+        except OSError:
+            addresses = []
+        _proxy_addresses[entry] = (time.monotonic() + PROXY_DNS_TTL_SECONDS, addresses)
+    return addresses
+
+
+def is_trusted_proxy(address):
+    """Whether ``address`` belongs to one of TRUSTED_PROXIES."""
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(
+        address in network
+        for entry in TRUSTED_PROXIES
+        for network in proxy_addresses(entry)
+    )
+
+
+def client_key():
+    """Identify the caller.
+
+    The web app forwards the browser's address in X-Forwarded-For, but the
+    header is only believed from a trusted proxy; anyone else could rotate it
+    to get a fresh rate-limit bucket on every request.
+    """
+    forwarded = request.headers.get("X-Forwarded-For", "")
+    if forwarded and is_trusted_proxy(request.remote_addr):
+        return forwarded.split(",")[0].strip() or request.remote_addr
+    return request.remote_addr
+
+
+def check_duration(path):
+    """Raise AudioTooLong if the audio is longer than MAX_AUDIO_SECONDS.
+
+    Only formats that record their length in the header are checked here;
+    analyze_emotion checks the rest once they are decoded.
+    """
+    duration = audio_duration(path)
+    if MAX_AUDIO_SECONDS > 0 and duration is not None:
+        if duration > MAX_AUDIO_SECONDS:
+            raise AudioTooLong(duration, MAX_AUDIO_SECONDS)
+
+
+def rejection_response(rejected):
+    """Count a rejection and turn it into a JSON error response."""
+    METRICS.increment(f"rejected_{rejected.reason}")
+    return jsonify({"error": str(rejected)}), rejected.status, rejected.headers()
+
+
+def analyze_inside_gate(path):
+    """Run analyze_emotion while holding an inference slot.
+
+    Waiting for memory is bounded by the same QUEUE_TIMEOUT_SECONDS as waiting
+    for a slot, and times out with the same fast 503.
+    """
+    try:
+        return analyze_emotion(
+            path,
+            return_details=True,
+            max_seconds=MAX_AUDIO_SECONDS,
+            timeout=INFERENCE_GATE.queue_timeout,
+        )
+    except TimeoutError as error:
+        raise Rejected(
+            503,
+            "memory_timeout",
+            "Server busy, try again later",
+            retry_after=INFERENCE_GATE.queue_timeout,
+        ) from error
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Expose admission counters and current queue state."""
+    counters = METRICS.snapshot()
+    counters["inferences_active"] = INFERENCE_GATE.active
+    counters["inferences_waiting"] = INFERENCE_GATE.waiting
+    return jsonify(counters)
+
 
 @app.route("/analyze", methods=["POST"])
 def analyze():
@@ -17,6 +139,11 @@ def analyze():
     if "audio" not in request.files:
         return jsonify({"error": "No file part"}), 400
 
+    try:
+        RATE_LIMITER.check(client_key())
+    except Rejected as rejected:
+        return rejection_response(rejected)
+
     file = request.files["audio"]
 
     # Save uploaded file to a temporary file
@@ -25,11 +152,14 @@ def analyze():
     temp_file.close()
 
     try:
-        # Analyze the audio file
-        emotion = analyze_emotion(temp_file.name)
+        check_duration(temp_file.name)
+        with INFERENCE_GATE.slot():
+            METRICS.increment("admitted")
+            # Analyze the audio file
+            details = analyze_inside_gate(temp_file.name)
 
         # Create result object
-        result = {"emotion": emotion, "timestamp": datetime.now(timezone.utc)}
+        result = {**details, "timestamp": datetime.now(timezone.utc)}
 
         # Store in MongoDB
         inserted = db.sound_result.insert_one(result)
@@ -37,6 +167,12 @@ def analyze():
 
         return jsonify({"status": "success", "result": result})
 
+    except Rejected as rejected:
+        return rejection_response(rejected)
+
+    except AudioTooLong as error:
+        return rejection_response(Rejected(413, "too_long", str(error)))
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
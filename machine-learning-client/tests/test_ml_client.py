@@ -5,8 +5,13 @@ Tests for the machine learning client component of the Voice Emotion Detection s
 import io
 import os
 import json
+import math
 import tempfile
+import threading
+import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+import wave
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -120,7 +125,18 @@ sys.modules["speechbrain.inference"] = speechbrain_mock.inference
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import main  # pylint: disable=wrong-import-position
 from main import app, analyze_emotion  # pylint: disable=wrong-import-position
+import bulk_rescore  # pylint: disable=wrong-import-position
+import benchmark_adaptive  # pylint: disable=wrong-import-position
+import inference_planner  # pylint: disable=wrong-import-position
+import emotion_analyzer  # pylint: disable=wrong-import-position
+from emotion_analyzer import window_bounds  # pylint: disable=wrong-import-position
+from admission import (  # pylint: disable=wrong-import-position
+    AdmissionGate,
+    Rejected,
+    TokenBucketLimiter,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -137,6 +153,12 @@ def mock_mongo_client(monkeypatch):
     return mongo_client_mock
 
 
+@pytest.fixture(autouse=True)
+def fresh_classifier(monkeypatch):
+    """Drop the process-wide classifier so each test loads its own mock."""
+    monkeypatch.setattr("emotion_analyzer._classifier", None)
+
+
 @pytest.fixture
 def client():
     """Create a test client for the Flask app."""
@@ -210,7 +232,7 @@ def test_emotion_analyzer(
     mock_classifier_instance.mods.output_mlp.return_value = mock_logits
     mock_logits.squeeze.return_value = MagicMock()
 
-    mock_load.return_value = (MagicMock(), MagicMock())
+    mock_load.return_value = (MagicMock(shape=(1, 16000)), 16000)
 
     mock_probs = MagicMock()
     mock_softmax.return_value = mock_probs
@@ -221,3 +243,781 @@ def test_emotion_analyzer(
 
     result = analyze_emotion("dummy_path.wav")
     assert result == "HAPPY"
+
+
+def _rescore_options(tmp_path, **overrides):
+    """Build an options namespace for bulk_rescore.run_rescore."""
+    options = bulk_rescore.parse_args(
+        ["--model-version", "v2", "--workers", "1", "--batch-size", "2"]
+    )
+    options.checkpoint = str(tmp_path / "progress.ckpt")
+    for key, value in overrides.items():
+        setattr(options, key, value)
+    return options
+
+
+def test_bulk_rescore_discover_files(tmp_path):
+    """Directory walk keeps audio files only; manifests skip comments."""
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "a.wav").write_bytes(DUMMY_AUDIO)
+    (tmp_path / "nested" / "b.webm").write_bytes(DUMMY_AUDIO)
+    (tmp_path / "notes.txt").write_text("not audio")
+    found = bulk_rescore.discover_files(str(tmp_path))
+    assert [os.path.basename(path) for path in found] == ["a.wav", "b.webm"]
+
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# header\n/x/2.wav\n\n/x/1.wav\n")
+    assert bulk_rescore.discover_files("", str(manifest)) == ["/x/1.wav", "/x/2.wav"]
+
+
+def test_bulk_rescore_shards_partition_paths():
+    """Every path lands in exactly one shard."""
+    paths = [f"/audio/{index}.wav" for index in range(50)]
+    counts = [
+        sum(bulk_rescore.in_shard(path, shard, 3) for shard in range(3))
+        for path in paths
+    ]
+    assert counts == [1] * len(paths)
+
+
+def test_bulk_rescore_bounded_map_limits_in_flight():
+    """Decoding never runs more than the window ahead of the consumer."""
+    in_flight = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def work(item):
+        return item * 2
+
+    class CountingExecutor(ThreadPoolExecutor):
+        """Counts submitted results that have not been consumed yet."""
+
+        def submit(self, fn, /, *args, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            return super().submit(fn, *args, **kwargs)
+
+    results = []
+    with CountingExecutor(max_workers=4) as executor:
+        for result in bulk_rescore.bounded_map(executor, work, range(100), 5):
+            with lock:
+                in_flight[0] -= 1
+            results.append(result)
+    assert results == [item * 2 for item in range(100)]
+    assert peak[0] == 5
+
+
+@patch("emotion_analyzer.torchaudio.functional", create=True)
+@patch("emotion_analyzer.torchaudio.load")
+def test_load_audio_mixes_to_mono_16k(mock_load, mock_functional):
+    """Stereo and non-16 kHz audio is mixed down and resampled."""
+    stereo = MagicMock(shape=(2, 48000))
+    mock_load.return_value = (stereo, 48000)
+    assert emotion_analyzer.load_audio("clip.webm") is (
+        mock_functional.resample.return_value
+    )
+    stereo.mean.assert_called_once_with(dim=0, keepdim=True)
+    mock_functional.resample.assert_called_once_with(
+        stereo.mean.return_value, 48000, 16000
+    )
+
+    mock_functional.reset_mock()
+    mono = MagicMock(shape=(1, 16000))
+    mock_load.return_value = (mono, 16000)
+    assert emotion_analyzer.load_audio("clip.wav") is mono
+    mono.mean.assert_not_called()
+    mock_functional.resample.assert_not_called()
+
+
+@patch("emotion_analyzer.classify_full")
+@patch("emotion_analyzer.load_audio")
+@patch("emotion_analyzer.load_classifier")
+def test_analyze_emotion_uses_shared_decoding(
+    _mock_classifier, mock_load_audio, mock_full, monkeypatch
+):
+    """Live inference feeds the model what load_audio returns, at 16 kHz."""
+    monkeypatch.delenv("EMOTION_MODEL", raising=False)
+    waveform = MagicMock(shape=(1, 32000))
+    mock_load_audio.return_value = waveform
+    mock_full.return_value = ("hap", 0.8, 32000)
+    details = analyze_emotion("clip.webm", adaptive=False, return_details=True)
+    assert mock_full.call_args.args[1] is waveform
+    assert details["audio_seconds"] == 2
+
+
+@patch("bulk_rescore.load_audio")
+def test_bulk_rescore_decode_file(mock_load_audio):
+    """Workers decode with load_audio; empty or broken files become errors."""
+    waveform = MagicMock()
+    waveform.__getitem__.return_value.shape = (16000,)
+    mock_load_audio.return_value = waveform
+    path, decoded, error = bulk_rescore.decode_file("clip.webm")
+    assert (path, error) == ("clip.webm", None)
+    assert decoded is waveform.__getitem__.return_value
+    waveform.__getitem__.assert_called_once_with(0)
+
+    waveform.__getitem__.return_value.shape = (0,)
+    assert bulk_rescore.decode_file("empty.wav") == (
+        "empty.wav",
+        None,
+        "Audio file contains no samples",
+    )
+
+    mock_load_audio.side_effect = RuntimeError("bad header")
+    assert bulk_rescore.decode_file("bad.wav") == ("bad.wav", None, "bad header")
+
+
+def test_bulk_rescore_default_checkpoint_name_is_a_plain_file():
+    """Path separators in the model version do not leak into the filename."""
+    options = bulk_rescore.parse_args(["--model-version", "speechbrain/emotion-v2"])
+    assert options.checkpoint == "rescore-speechbrain_emotion-v2-0of1.ckpt"
+    assert options.model_version == "speechbrain/emotion-v2"
+
+
+def test_bulk_rescore_parse_args_rejects_bad_shard():
+    """Shard index must be smaller than the shard count."""
+    with pytest.raises(SystemExit):
+        bulk_rescore.parse_args(
+            ["--model-version", "v2", "--shard-index", "2", "--num-shards", "2"]
+        )
+
+
+@patch("bulk_rescore.score_batch")
+@patch("bulk_rescore.decode_file")
+def test_bulk_rescore_run_is_resumable(mock_decode, mock_score, tmp_path):
+    """Results are bulk-written per batch and checkpointed paths are skipped."""
+    mock_decode.side_effect = lambda path: (
+        (path, None, "corrupt")
+        if path.endswith("bad.wav")
+        else (path, MagicMock(shape=(16000,)), None)
+    )
+    mock_score.side_effect = lambda _, waveforms, __: [("HAPPY", 0.9)] * len(waveforms)
+    collection = MagicMock()
+    paths = ["/data/a.wav", "/data/b.wav", "/data/bad.wav", "/data/x/c.wav"]
+    options = _rescore_options(tmp_path, source="/data")
+
+    summary = bulk_rescore.run_rescore(paths, collection, MagicMock(), options)
+    assert summary["scored"] == 3
+    assert summary["failed"] == 1
+    assert summary["files_per_sec"] > 0
+    assert collection.bulk_write.call_count == 2
+    operations = collection.bulk_write.call_args_list[0].args[0]
+    assert operations[0]._filter == {  # pylint: disable=protected-access
+        "source": "a.wav",
+        "model_version": "v2",
+    }
+    assert bulk_rescore.load_checkpoint(options.checkpoint) == {
+        "a.wav",
+        "b.wav",
+        os.path.join("x", "c.wav"),
+    }
+
+    collection.reset_mock()
+    summary = bulk_rescore.run_rescore(paths, collection, MagicMock(), options)
+    assert summary["scored"] == 0
+    assert summary["resumed"] == 3
+    assert summary["other_shards"] == 0
+    collection.bulk_write.assert_not_called()
+
+
+def test_bulk_rescore_counts_resumed_and_other_shards(tmp_path):
+    """Checkpointed files and other shards' files are reported separately."""
+    keys = [f"{index}.wav" for index in range(30)]
+    paths = [f"/audio/{key}" for key in keys]
+    options = _rescore_options(tmp_path, source="/audio", shard_index=1, num_shards=3)
+    mine = [key for key in keys if bulk_rescore.in_shard(key, 1, 3)]
+    bulk_rescore.append_checkpoint(options.checkpoint, mine[:2])
+    pending, resumed, other_shards = bulk_rescore.partition_paths(paths, options)
+    assert pending == [f"/audio/{key}" for key in mine[2:]]
+    assert resumed == 2
+    assert other_shards == len(paths) - len(mine)
+
+
+def test_bulk_rescore_keys_do_not_depend_on_mount_point(tmp_path):
+    """Two machines mounting the corpus at different roots split it the same way."""
+    names = [f"clips/{index}.wav" for index in range(20)]
+    splits = []
+    for root in ("/mnt/audio", "/srv/corpus"):
+        options = _rescore_options(tmp_path, source=root, shard_index=0, num_shards=2)
+        pending, _, _ = bulk_rescore.partition_paths(
+            [f"{root}/{name}" for name in names], options
+        )
+        splits.append([bulk_rescore.source_key(path, root) for path in pending])
+    assert splits[0] == splits[1]
+    assert 0 < len(splits[0]) < len(names)
+
+
+def test_analyze_emotion_stub_model(monkeypatch, tmp_path):
+    """EMOTION_MODEL=stub returns a stable label without loading the model."""
+    monkeypatch.setenv("EMOTION_MODEL", "stub")
+    audio = tmp_path / "clip.wav"
+    audio.write_bytes(DUMMY_AUDIO)
+    with patch("emotion_analyzer.EncoderClassifier.from_hparams") as mock_load:
+        label = analyze_emotion(str(audio))
+        assert analyze_emotion(str(audio)) == label
+    assert label in ("neu", "ang", "hap", "sad")
+    mock_load.assert_not_called()
+
+
+def test_stub_latency_scales_with_clip_length(monkeypatch, tmp_path):
+    """The stub sleeps a fixed latency plus a per-audio-second latency."""
+    monkeypatch.setenv("EMOTION_MODEL", "stub")
+    monkeypatch.setenv("STUB_LATENCY_MS", "10")
+    monkeypatch.setenv("STUB_LATENCY_MS_PER_SECOND", "50")
+    audio = tmp_path / "clip.wav"
+    audio.write_bytes(_wav_upload(4)["audio"][0].getvalue())
+    with patch("emotion_analyzer.time.sleep") as mock_sleep:
+        analyze_emotion(str(audio))
+    mock_sleep.assert_called_once_with(pytest.approx(0.21))
+
+    webm = tmp_path / "clip.webm"
+    webm.write_bytes(DUMMY_AUDIO)
+    with patch("emotion_analyzer.time.sleep") as mock_sleep, patch(
+        "emotion_analyzer.load_audio", return_value=MagicMock(shape=(1, 16000 * 2))
+    ):
+        details = analyze_emotion(str(webm), return_details=True)
+    mock_sleep.assert_called_once_with(pytest.approx(0.11))
+    assert details["audio_seconds"] == 2
+
+
+def _wav_upload(seconds, rate=8000):
+    """Multipart form data holding a silent WAV file of the given length."""
+    buffer = io.BytesIO()
+    with wave.Wave_write(buffer) as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(b"\x00\x00" * int(seconds * rate))
+    buffer.seek(0)
+    return {"audio": (buffer, "clip.wav", "audio/wav")}
+
+
+def test_audio_duration_treats_zero_sample_rate_as_unknown(tmp_path):
+    """A WAV header claiming 0 Hz has no known duration instead of crashing."""
+    data = bytearray(_wav_upload(1)["audio"][0].getvalue())
+    data[24:32] = bytes(8)  # sample rate and byte rate
+    audio = tmp_path / "broken.wav"
+    audio.write_bytes(bytes(data))
+    assert emotion_analyzer.audio_duration(str(audio)) is None
+
+
+def test_token_bucket_refills_over_time():
+    """Each client gets a burst, then tokens at the configured rate."""
+    now = [0.0]
+    limiter = TokenBucketLimiter(rate=2, burst=2, clock=lambda: now[0])
+    limiter.check("a")
+    limiter.check("a")
+    with pytest.raises(Rejected) as excinfo:
+        limiter.check("a")
+    assert excinfo.value.status == 429
+    assert excinfo.value.headers() == {"Retry-After": "1"}
+    limiter.check("b")
+    now[0] = 0.5
+    limiter.check("a")
+
+
+def test_token_bucket_prunes_idle_clients():
+    """Idle, fully refilled buckets are forgotten once over max_clients."""
+    now = [0.0]
+    limiter = TokenBucketLimiter(rate=1, burst=1, max_clients=2, clock=lambda: now[0])
+    limiter.check("a")
+    now[0] = 5.0
+    limiter.check("b")
+    limiter.check("c")
+    assert set(limiter._buckets) == {"b", "c"}  # pylint: disable=protected-access
+
+
+def test_admission_gate_bounds_queue():
+    """Waiters beyond the queue bound fail fast; others time out."""
+    gate = AdmissionGate(max_concurrent=1, max_queue=1, queue_timeout=0.2)
+    release = threading.Event()
+    waiter_error = []
+
+    def waiter():
+        try:
+            with gate.slot():
+                pass
+        except Rejected as rejected:
+            waiter_error.append(rejected.reason)
+
+    with gate.slot():
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        while gate.waiting == 0:
+            release.wait(0.001)
+        with pytest.raises(Rejected) as excinfo:
+            with gate.slot():
+                pass
+        assert excinfo.value.reason == "queue_full"
+        thread.join()
+    assert waiter_error == ["queue_timeout"]
+    assert gate.active == 0
+    with gate.slot():
+        assert gate.active == 1
+
+
+@patch("main.db", new=MagicMock())
+@patch("main.analyze_emotion")
+@patch("main.RATE_LIMITER", new=TokenBucketLimiter(rate=0.001, burst=1))
+@patch("main.TRUSTED_PROXIES", new=("127.0.0.0/8",))
+def test_analyze_rate_limited_per_client(
+    mock_analyze, client
+):  # pylint: disable=redefined-outer-name
+    """Behind a trusted proxy, clients are limited by X-Forwarded-For."""
+    mock_analyze.return_value = {"emotion": "hap", "confidence": 0.9}
+    statuses = [
+        client.post(
+            "/analyze",
+            data=_wav_upload(0.1),
+            headers={"X-Forwarded-For": address},
+            content_type="multipart/form-data",
+        ).status_code
+        for address in ("10.0.0.1", "10.0.0.1", "10.0.0.2")
+    ]
+    assert statuses == [200, 429, 200]
+    metrics = json.loads(client.get("/metrics").data)
+    assert metrics["rejected_rate_limited"] >= 1
+    assert metrics["inferences_active"] == 0
+
+
+@patch("main.analyze_emotion")
+@patch("main.MAX_AUDIO_SECONDS", new=1.0)
+def test_analyze_rejects_long_audio_before_decoding(
+    mock_analyze, client
+):  # pylint: disable=redefined-outer-name
+    """Over-long WAV files are refused from the header alone."""
+    response = client.post(
+        "/analyze", data=_wav_upload(2), content_type="multipart/form-data"
+    )
+    assert response.status_code == 413
+    mock_analyze.assert_not_called()
+
+
+@patch("emotion_analyzer.classify_full")
+@patch("emotion_analyzer.classify_windowed")
+@patch("emotion_analyzer.load_audio")
+@patch("emotion_analyzer.load_classifier")
+@patch("main.MAX_AUDIO_SECONDS", new=60.0)
+def test_analyze_rejects_long_audio_without_header_duration(
+    _mock_classifier,
+    mock_load_audio,
+    mock_windowed,
+    mock_full,
+    client,
+    monkeypatch,
+):  # pylint: disable=redefined-outer-name,too-many-arguments
+    """Browser webm has no duration up front; the decoded length is checked."""
+    monkeypatch.delenv("EMOTION_MODEL", raising=False)
+    mock_load_audio.return_value = MagicMock(shape=(1, 16000 * 90))
+    response = client.post(
+        "/analyze",
+        data={"audio": (io.BytesIO(b"\x1aE\xdf\xa3webm"), "clip.webm", "audio/webm")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 413
+    assert "90.0s" in json.loads(response.data)["error"]
+    mock_windowed.assert_not_called()
+    mock_full.assert_not_called()
+    assert json.loads(client.get("/metrics").data)["rejected_too_long"] >= 1
+
+
+@patch("main.analyze_emotion")
+@patch("main.INFERENCE_GATE", new=AdmissionGate(1, 0, 0.01))
+def test_analyze_busy_returns_503(
+    mock_analyze, client
+):  # pylint: disable=redefined-outer-name
+    """With every inference slot taken and no queue, requests get 503."""
+    from main import INFERENCE_GATE  # pylint: disable=import-outside-toplevel
+
+    with INFERENCE_GATE.slot():
+        response = client.post(
+            "/analyze", data=_wav_upload(0.1), content_type="multipart/form-data"
+        )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    mock_analyze.assert_not_called()
+
+
+@patch("main.analyze_emotion", side_effect=TimeoutError("no memory"))
+@patch("main.INFERENCE_GATE", new=AdmissionGate(1, 1, 4))
+def test_analyze_memory_timeout_returns_503(
+    mock_analyze, client
+):  # pylint: disable=redefined-outer-name
+    """Waiting too long for inference memory fails fast and is counted."""
+    response = client.post(
+        "/analyze", data=_wav_upload(0.1), content_type="multipart/form-data"
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "4"
+    assert mock_analyze.call_args.kwargs["timeout"] == 4
+    metrics = json.loads(client.get("/metrics").data)
+    assert metrics["rejected_memory_timeout"] >= 1
+    assert metrics["inferences_active"] == 0
+
+
+@patch("emotion_analyzer.classify_full")
+@patch("emotion_analyzer.load_audio")
+@patch("emotion_analyzer.load_classifier")
+def test_analyze_emotion_memory_wait_is_bounded(
+    _mock_classifier, mock_load_audio, mock_full, monkeypatch
+):
+    """A full memory budget raises TimeoutError instead of waiting forever."""
+    monkeypatch.delenv("EMOTION_MODEL", raising=False)
+    budget = inference_planner.MemoryBudget(
+        inference_planner.estimate_peak_bytes(16000 * 30), rss=lambda: 0
+    )
+    monkeypatch.setattr("emotion_analyzer.MEMORY_BUDGET", budget)
+    mock_load_audio.return_value = MagicMock(shape=(1, 16000))
+    with budget.reserve(budget.ceiling_bytes):
+        with pytest.raises(TimeoutError):
+            analyze_emotion("clip.wav", adaptive=False, timeout=0.01)
+    mock_full.assert_not_called()
+
+
+def test_window_bounds_evens_out_short_tail():
+    """Windows cover every sample; a short tail is evened out with its neighbour."""
+    assert window_bounds(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert window_bounds(9, 4) == [(0, 4), (4, 6), (6, 9)]
+    assert window_bounds(3, 4) == [(0, 3)]
+    assert not window_bounds(0, 4)
+
+
+def test_analyze_stub_model_details(monkeypatch, tmp_path):
+    """The stub model returns the same detail keys as the real one."""
+    monkeypatch.setenv("EMOTION_MODEL", "stub")
+    audio = tmp_path / "clip.wav"
+    audio.write_bytes(_wav_upload(2)["audio"][0].getvalue())
+    details = analyze_emotion(str(audio), return_details=True)
+    assert details == {
+        "emotion": analyze_emotion(str(audio)),
+        "confidence": None,
+        "audio_seconds": 2,
+        "processed_seconds": 2,
+        "early_exit": False,
+    }
+
+
+@patch("main.db", new=MagicMock())
+@patch("main.analyze_emotion")
+def test_analyze_reports_processed_audio(
+    mock_analyze, client
+):  # pylint: disable=redefined-outer-name
+    """The response says how much of the clip the model actually processed."""
+    mock_analyze.return_value = {
+        "emotion": "hap",
+        "confidence": 0.95,
+        "audio_seconds": 12.0,
+        "processed_seconds": 3.0,
+        "early_exit": True,
+    }
+    response = client.post(
+        "/analyze", data=_wav_upload(0.1), content_type="multipart/form-data"
+    )
+    assert response.status_code == 200
+    result = json.loads(response.data)["result"]
+    assert result["processed_seconds"] == 3.0
+    assert result["early_exit"] is True
+    assert mock_analyze.call_args.kwargs == {
+        "return_details": True,
+        "max_seconds": main.MAX_AUDIO_SECONDS,
+        "timeout": main.INFERENCE_GATE.queue_timeout,
+    }
+
+
+def test_benchmark_adaptive_summary():
+    """Agreement, audio used and time saved are aggregated per threshold."""
+    results = [
+        (("hap", 2.0), {0.9: ("hap", 0.5, 0.25)}),
+        (("sad", 2.0), {0.9: ("neu", 1.5, 0.75)}),
+    ]
+    row = benchmark_adaptive.summarize(results, [0.9])[0]
+    assert row == {
+        "threshold": 0.9,
+        "agreement": 0.5,
+        "audio_processed": 0.5,
+        "time_saved": 0.5,
+    }
+    table = benchmark_adaptive.format_rows([row])
+    assert "50.0%" in table
+
+
+def test_estimate_peak_bytes_grows_superlinearly():
+    """Doubling the input more than doubles the per-item estimate."""
+    base = inference_planner.BASE_OVERHEAD_BYTES
+    short = inference_planner.estimate_peak_bytes(16000 * 30) - base
+    long = inference_planner.estimate_peak_bytes(16000 * 60) - base
+    assert long > 2 * short
+    batched = inference_planner.estimate_peak_bytes(16000, batch_size=4) - base
+    assert batched == 4 * (inference_planner.estimate_peak_bytes(16000) - base)
+
+
+def test_max_chunk_samples_fits_budget():
+    """The chunk is the longest input that fits, within the configured bounds."""
+    limit = 16000 * 30
+    assert inference_planner.max_chunk_samples(None, limit) == limit
+    budget = inference_planner.estimate_peak_bytes(16000 * 10)
+    chunk = inference_planner.max_chunk_samples(budget, limit)
+    assert inference_planner.estimate_peak_bytes(chunk) <= budget
+    assert inference_planner.estimate_peak_bytes(chunk + 1) > budget
+    assert inference_planner.max_chunk_samples(0, limit) == (
+        inference_planner.MIN_CHUNK_SAMPLES
+    )
+
+
+def test_bucket_by_length_limits_padding_and_size():
+    """Similar lengths share a batch; outliers and overflow start new ones."""
+    lengths = [100, 5000, 110, 4900, 105, 120]
+    batches = inference_planner.bucket_by_length(lengths, max_batch_size=3)
+    assert batches == [[0, 4, 2], [5], [3, 1]]
+    budget = inference_planner.estimate_peak_bytes(5000, batch_size=1)
+    assert inference_planner.bucket_by_length([4900, 5000], 8, budget) == [[0], [1]]
+    assert inference_planner.bucket_by_length([0, 100, 0], 8) == [[0, 2], [1]]
+
+
+def test_memory_budget_waits_for_room():
+    """Reservations past the ceiling wait until earlier ones are released."""
+    budget = inference_planner.MemoryBudget(100, rss=lambda: 40)
+    assert budget.available() == 60
+    with budget.reserve(50):
+        with pytest.raises(TimeoutError):
+            with budget.reserve(20, timeout=0.01):
+                pass
+        assert budget.reserved == 50
+    with budget.reserve(500):
+        assert budget.reserved == 500
+    assert budget.reserved == 0
+    unlimited = inference_planner.MemoryBudget(0)
+    assert unlimited.available() is None
+    with unlimited.reserve(10**12):
+        pass
+
+
+def test_bulk_rescore_plan_batches_isolates_overlong_clips():
+    """Clips longer than the chunk size are scored alone."""
+    batches = bulk_rescore.plan_batches([100, 900, 110, 120], 8, 500, None)
+    assert batches == [[1], [0, 2, 3]]
+
+
+@patch("emotion_analyzer.classify_full")
+@patch("emotion_analyzer.classify_windowed")
+@patch("emotion_analyzer.torchaudio.load")
+@patch("emotion_analyzer.load_classifier")
+def test_analyze_emotion_chunks_long_audio(
+    _mock_classifier, mock_load, mock_windowed, mock_full, monkeypatch
+):
+    """Audio longer than the encoder chunk is encoded in chunks and pooled."""
+    monkeypatch.delenv("EMOTION_MODEL", raising=False)
+    monkeypatch.setattr("emotion_analyzer.ENCODER_CHUNK_SECONDS", 30)
+    mock_load.return_value = (MagicMock(shape=(1, 16000 * 45)), 16000)
+    mock_windowed.return_value = ("sad", 0.6, 16000 * 45)
+    details = analyze_emotion("long.wav", adaptive=False, return_details=True)
+    assert details["emotion"] == "sad"
+    assert details["processed_seconds"] == 45
+    assert details["early_exit"] is False
+    assert mock_windowed.call_args.args[2:] == (16000 * 30, None)
+    mock_full.assert_not_called()
+
+
+@patch("main.db", new=MagicMock())
+@patch("main.analyze_emotion")
+@patch("main.RATE_LIMITER", new=TokenBucketLimiter(rate=0.001, burst=1))
+@patch("main.TRUSTED_PROXIES", new=("10.1.2.3", "proxy.invalid"))
+def test_analyze_ignores_spoofed_forwarded_for(
+    mock_analyze, client
+):  # pylint: disable=redefined-outer-name
+    """Rotating X-Forwarded-For from an untrusted caller does not dodge limits."""
+    mock_analyze.return_value = {"emotion": "hap", "confidence": 0.9}
+    statuses = [
+        client.post(
+            "/analyze",
+            data=_wav_upload(0.1),
+            headers={"X-Forwarded-For": address},
+            content_type="multipart/form-data",
+        ).status_code
+        for address in ("10.0.0.1", "10.0.0.2", "10.0.0.3")
+    ]
+    assert statuses == [200, 429, 429]
+
+
+def test_trusted_proxy_matching():
+    """Proxies match by address, network or resolved host name."""
+    with patch("main.TRUSTED_PROXIES", new=("172.18.0.0/16", "web")), patch(
+        "main.socket.gethostbyname_ex", return_value=("web", [], ["10.9.8.7"])
+    ), patch.dict("main._proxy_addresses", clear=True):
+        assert main.is_trusted_proxy("172.18.3.4")
+        assert main.is_trusted_proxy("10.9.8.7")
+        assert not main.is_trusted_proxy("10.9.8.6")
+        assert not main.is_trusted_proxy("not-an-ip")
+
+
+class FakeTensor(list):
+    """Plain-list stand-in for the few tensor methods classify_windowed uses."""
+
+    def view(self, *_):
+        """Shapes do not matter for the fake."""
+        return self
+
+
+class FakeScalar:  # pylint: disable=too-few-public-methods
+    """Stand-in for a 0-d tensor."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def item(self):
+        """Return the wrapped number."""
+        return self.value
+
+
+class FakeWaveform:
+    """Mono waveform whose slices are just their ``(start, end)`` bounds."""
+
+    def __init__(self, num_samples):
+        self.shape = (1, num_samples)
+
+    def mean(self, **_):
+        """Already mono."""
+        return self
+
+    def __getitem__(self, index):
+        return (index[1].start, index[1].stop)
+
+
+def _fake_softmax(logits, dim=0):  # pylint: disable=unused-argument
+    """Softmax over a plain list of logits."""
+    exps = [math.exp(value) for value in logits]
+    return FakeTensor(value / sum(exps) for value in exps)
+
+
+def _fake_max(probs, dim=0):  # pylint: disable=unused-argument
+    """Return ``(max, argmax)`` of a plain list."""
+    index = max(range(len(probs)), key=probs.__getitem__)
+    return FakeScalar(probs[index]), FakeScalar(index)
+
+
+def _fake_window_classifier(embeddings):
+    """Classifier whose pooled embedding per window is ``embeddings[start]``.
+
+    The embedding is the first logit, so a large pooled value makes the
+    running prediction confident. ``output_mlp`` records its inputs.
+    """
+    classifier = MagicMock()
+    classifier.mods.wav2vec2.side_effect = lambda bounds: bounds
+    classifier.mods.avg_pool.side_effect = lambda bounds: embeddings[bounds[0]]
+    classifier.mods.output_mlp.side_effect = lambda pooled: FakeTensor(
+        [pooled, 0.0, 0.0, 0.0]
+    )
+    classifier.hparams.label_encoder.decode_ndim.return_value = "ang"
+    return classifier
+
+
+def _run_adaptive(monkeypatch, classifier, num_samples, threshold):
+    """Run analyze_emotion in adaptive mode with one-second windows."""
+    monkeypatch.delenv("EMOTION_MODEL", raising=False)
+    monkeypatch.setenv("ADAPTIVE_WINDOW_SECONDS", "1")
+    monkeypatch.setenv("ADAPTIVE_CONFIDENCE", str(threshold))
+    with patch("emotion_analyzer.load_classifier", return_value=classifier), patch(
+        "emotion_analyzer.torchaudio.load",
+        return_value=(FakeWaveform(num_samples), 16000),
+    ), patch("emotion_analyzer.F.softmax", _fake_softmax), patch.object(
+        torch_mock, "max", _fake_max, create=True
+    ):
+        return analyze_emotion("clip.wav", adaptive=True, return_details=True)
+
+
+def test_adaptive_inference_stops_on_confident_prefix(monkeypatch):
+    """A confident first window ends inference after one window."""
+    classifier = _fake_window_classifier({0: 10.0, 16000: 10.0, 32000: 10.0})
+    details = _run_adaptive(monkeypatch, classifier, 48000, threshold=0.9)
+    assert details["emotion"] == "ang"
+    assert details["confidence"] >= 0.9
+    assert details["audio_seconds"] == 3
+    assert details["processed_seconds"] == 1
+    assert details["early_exit"] is True
+    assert classifier.mods.wav2vec2.call_count == 1
+
+
+def test_adaptive_inference_continues_when_not_confident(monkeypatch):
+    """Without a confident window, every window is encoded and length-weighted."""
+    embeddings = {0: 0.0, 16000: 1.0, 32000: 2.0, 48000: 4.0}
+    classifier = _fake_window_classifier(embeddings)
+    details = _run_adaptive(monkeypatch, classifier, 56000, threshold=0.99)
+    assert details["processed_seconds"] == 3.5
+    assert details["audio_seconds"] == 3.5
+    assert details["early_exit"] is False
+    assert classifier.mods.wav2vec2.call_count == 4
+    final_pooled = classifier.mods.output_mlp.call_args.args[0]
+    expected = (0.0 * 16000 + 1.0 * 16000 + 2.0 * 16000 + 4.0 * 8000) / 56000
+    assert final_pooled == pytest.approx(expected)
+    assert details["confidence"] == pytest.approx(
+        _fake_softmax([expected, 0.0, 0.0, 0.0])[0]
+    )
+
+
+def test_classify_full_mixes_stereo_to_one_item():
+    """A stereo waveform is encoded as one mono item, not a batch of two."""
+    stereo = MagicMock(shape=(2, 16000))
+    classifier = MagicMock()
+    with patch("emotion_analyzer.F.softmax"):
+        _, _, samples = emotion_analyzer.classify_full(classifier, stereo)
+    stereo.mean.assert_called_once_with(dim=0, keepdim=True)
+    classifier.mods.wav2vec2.assert_called_once_with(stereo.mean.return_value)
+    assert samples == 16000
+
+
+def test_load_classifier_loads_once_per_process():
+    """Concurrent callers share one classifier instead of loading their own."""
+    barrier = threading.Barrier(4)
+    loaded = []
+
+    def load():
+        barrier.wait()
+        loaded.append(emotion_analyzer.load_classifier())
+
+    with patch("emotion_analyzer.EncoderClassifier.from_hparams") as mock_load:
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    mock_load.assert_called_once()
+    assert all(classifier is loaded[0] for classifier in loaded)
+
+
+def test_concurrent_inferences_with_model_loading_stay_under_ceiling():
+    """Weights loaded once plus concurrent reservations never pass the ceiling."""
+    weights, activations, ceiling = 400, 150, 1000
+    lock = threading.Lock()
+    usage = {"rss": 100, "peak": 100}
+
+    def allocate(nbytes):
+        with lock:
+            usage["rss"] += nbytes
+            usage["peak"] = max(usage["peak"], usage["rss"])
+
+    def from_hparams(**_):
+        allocate(weights)
+        return MagicMock()
+
+    budget = inference_planner.MemoryBudget(ceiling, rss=lambda: usage["rss"])
+    start = threading.Barrier(6)
+
+    def inference():
+        start.wait()
+        emotion_analyzer.load_classifier()
+        with budget.reserve(activations):
+            allocate(activations)
+            time.sleep(0.01)
+            allocate(-activations)
+
+    with patch(
+        "emotion_analyzer.EncoderClassifier.from_hparams", side_effect=from_hparams
+    ):
+        threads = [threading.Thread(target=inference) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert usage["rss"] == 100 + weights
+    assert usage["peak"] <= ceiling
@@ -5,10 +5,12 @@ This module handles web routes and communication with the ML client.
 
 import os
 import json
+import wave
 import requests
 from flask import Flask, render_template, request, jsonify
 import pymongo
 from dotenv import load_dotenv
+from admission import AdmissionGate, Metrics, Rejected, TokenBucketLimiter
 
 # Load environment variables
 load_dotenv()
@@ -30,6 +32,57 @@ except pymongo.errors.ServerSelectionTimeoutError as err:
     print(f"MongoDB connection error: {err}")
     DB = None
 
+# Admission control; see admission.py. Zero disables the duration limit and
+# the per-client rate limit.
+MAX_AUDIO_SECONDS = float(os.getenv("MAX_AUDIO_SECONDS", "120"))
+METRICS = Metrics()
+RATE_LIMITER = TokenBucketLimiter(
+    rate=float(os.getenv("RATE_LIMIT_PER_SECOND", "1")),
+    burst=float(os.getenv("RATE_LIMIT_BURST", "10")),
+)
+UPLOAD_GATE = AdmissionGate(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_UPLOADS", "8")),
+    max_queue=int(os.getenv("MAX_QUEUED_UPLOADS", "16")),
+    queue_timeout=float(os.getenv("QUEUE_TIMEOUT_SECONDS", "30")),
+)
+# ML client statuses that mean "try again later" and carry Retry-After.
+UPSTREAM_REJECTIONS = (413, 429, 503)
+
+
+def wav_duration(stream):
+    """
+    Read the duration in seconds from a WAV header, leaving the stream
+    rewound. Returns None for other formats and for headers with a zero
+    sample rate; the ML client checks those.
+    """
+    try:
+        with wave.open(stream, "rb") as reader:
+            rate = reader.getframerate()
+            return reader.getnframes() / rate if rate else None
+    except (wave.Error, EOFError):
+        return None
+    finally:
+        stream.seek(0)
+
+
+def check_upload(audio):
+    """Apply the rate limit and duration limit, raising Rejected on failure."""
+    RATE_LIMITER.check(request.remote_addr)
+    duration = wav_duration(audio.stream)
+    if MAX_AUDIO_SECONDS > 0 and duration is not None:
+        if duration > MAX_AUDIO_SECONDS:
+            raise Rejected(
+                413,
+                "too_long",
+                f"Audio is {duration:.1f}s; the limit is {MAX_AUDIO_SECONDS:g}s",
+            )
+
+
+def rejection_response(rejected):
+    """Count a rejection and turn it into a JSON error response."""
+    METRICS.increment(f"rejected_{rejected.reason}")
+    return jsonify({"error": str(rejected)}), rejected.status, rejected.headers()
+
 
 @app.route("/")
 def home():
@@ -51,28 +104,50 @@ def upload():
     if audio.filename == "":
         return jsonify({"error": "No selected file"}), 400
     try:
-        # Send file to ML client for analysis
-        response = requests.post(
-            f"{ml_client_host}/analyze",
-            files={"audio": (audio.filename, audio.stream, audio.content_type)},
-            timeout=60,  # Increased timeout for ML processing
-        )
-        # Check if response is valid
-        try:
-            result = response.json()
-            return jsonify(result), response.status_code
-        except json.JSONDecodeError:
-            return (
-                jsonify(
-                    {
-                        "error": "ML Client did not return valid JSON",
-                        "raw_response": response.text,
-                    }
-                ),
-                500,
+        check_upload(audio)
+        with UPLOAD_GATE.slot():
+            METRICS.increment("admitted")
+            # Send file to ML client for analysis
+            response = requests.post(
+                f"{ml_client_host}/analyze",
+                files={"audio": (audio.filename, audio.stream, audio.content_type)},
+                headers={"X-Forwarded-For": request.remote_addr or ""},
+                timeout=60,  # Increased timeout for ML processing
             )
+    except Rejected as rejected:
+        return rejection_response(rejected)
     except requests.RequestException as error:
         return jsonify({"error": f"Failed to connect to ML client: {str(error)}"}), 500
+    headers = {}
+    if response.status_code in UPSTREAM_REJECTIONS:
+        METRICS.increment("rejected_upstream")
+        if "Retry-After" in response.headers:
+            headers["Retry-After"] = response.headers["Retry-After"]
+    # Check if response is valid
+    try:
+        result = response.json()
+        return jsonify(result), response.status_code, headers
+    except json.JSONDecodeError:
+        return (
+            jsonify(
+                {
+                    "error": "ML Client did not return valid JSON",
+                    "raw_response": response.text,
+                }
+            ),
+            500,
+        )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Expose admission counters and current upload queue state.
+    """
+    counters = METRICS.snapshot()
+    counters["uploads_active"] = UPLOAD_GATE.active
+    counters["uploads_waiting"] = UPLOAD_GATE.waiting
+    return jsonify(counters)
 
 
 @app.route("/health", methods=["GET"])
@@ -6,8 +6,29 @@ import json
 import unittest
 from unittest.mock import patch, MagicMock
 import io
+import wave
 import requests
-from app import app
+from app import app, METRICS
+from admission import AdmissionGate, TokenBucketLimiter
+
+
+def make_wav(seconds, rate=8000):
+    """Return an in-memory silent mono WAV file of the given length."""
+    buffer = io.BytesIO()
+    with wave.Wave_write(buffer) as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(b"\x00\x00" * int(seconds * rate))
+    buffer.seek(0)
+    return buffer
+
+
+def zero_rate_wav():
+    """Return a WAV file whose header claims a sample rate of zero."""
+    data = bytearray(make_wav(1).getvalue())
+    data[24:32] = bytes(8)  # sample rate and byte rate
+    return io.BytesIO(bytes(data))
 
 
 class TestWebApp(unittest.TestCase):
@@ -147,3 +168,105 @@ class TestWebApp(unittest.TestCase):
         data = json.loads(response.data)
         assert data["status"] == "ok"
         assert data["ml_client_connected"] is False
+
+    @patch("app.requests.post")
+    @patch("app.RATE_LIMITER", new=TokenBucketLimiter(rate=0.001, burst=1))
+    def test_upload_rate_limited(self, mock_post):
+        """Test that a client over its rate limit gets 429 with Retry-After."""
+        mock_post.return_value.json.return_value = {"status": "success"}
+        mock_post.return_value.status_code = 200
+        before = METRICS.snapshot().get("rejected_rate_limited", 0)
+        for expected in (200, 429):
+            audio_file = (io.BytesIO(b"mock audio data"), "test_audio.wav")
+            response = self.client.post(
+                "/upload",
+                data={"audio": audio_file},
+                content_type="multipart/form-data",
+            )
+            assert response.status_code == expected
+        assert int(response.headers["Retry-After"]) >= 1
+        assert mock_post.call_count == 1
+        metrics = json.loads(self.client.get("/metrics").data)
+        assert metrics["rejected_rate_limited"] == before + 1
+
+    @patch("app.requests.post")
+    @patch("app.MAX_AUDIO_SECONDS", new=1.0)
+    def test_upload_too_long(self, mock_post):
+        """Test that WAV uploads over the duration limit are refused early."""
+        response = self.client.post(
+            "/upload",
+            data={"audio": (make_wav(2), "long.wav")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 413
+        assert "limit" in json.loads(response.data)["error"]
+        mock_post.assert_not_called()
+
+    @patch("app.requests.post")
+    @patch("app.MAX_AUDIO_SECONDS", new=5.0)
+    def test_upload_short_wav_is_forwarded_whole(self, mock_post):
+        """Test that reading the WAV header leaves the stream rewound."""
+        sent = {}
+
+        def capture(*_, **kwargs):
+            sent["data"] = kwargs["files"]["audio"][1].read()
+            response = MagicMock(status_code=200)
+            response.json.return_value = {"status": "success"}
+            return response
+
+        mock_post.side_effect = capture
+        audio = make_wav(1)
+        expected = audio.getvalue()
+        response = self.client.post(
+            "/upload",
+            data={"audio": (audio, "short.wav")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200
+        assert sent["data"] == expected
+
+    @patch("app.requests.post")
+    @patch("app.UPLOAD_GATE", new=AdmissionGate(1, 0, 0.01))
+    def test_upload_queue_full(self, mock_post):
+        """Test that uploads beyond the concurrency bound get 503."""
+        from app import UPLOAD_GATE  # pylint: disable=import-outside-toplevel
+
+        with UPLOAD_GATE.slot():
+            audio_file = (io.BytesIO(b"mock audio data"), "test_audio.wav")
+            response = self.client.post(
+                "/upload",
+                data={"audio": audio_file},
+                content_type="multipart/form-data",
+            )
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+        mock_post.assert_not_called()
+
+    @patch("app.requests.post")
+    def test_upload_passes_through_ml_client_rejection(self, mock_post):
+        """Test that ML client 503s keep their Retry-After header."""
+        mock_response = MagicMock()
+        mock_response.status_code = 503
+        mock_response.headers = {"Retry-After": "7"}
+        mock_response.json.return_value = {"error": "Server busy"}
+        mock_post.return_value = mock_response
+        audio_file = (io.BytesIO(b"mock audio data"), "test_audio.wav")
+        response = self.client.post(
+            "/upload", data={"audio": audio_file}, content_type="multipart/form-data"
+        )
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "7"
+
+    @patch("app.requests.post")
+    @patch("app.MAX_AUDIO_SECONDS", new=1.0)
+    def test_upload_zero_sample_rate_is_left_to_ml_client(self, mock_post):
+        """Test that a WAV header with a zero sample rate does not crash."""
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {"status": "success"}
+        response = self.client.post(
+            "/upload",
+            data={"audio": (zero_rate_wav(), "broken.wav")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200
+        mock_post.assert_called_once()